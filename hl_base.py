@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+# Base class for the high level transfer handlers
+# Michael Katzenberger
+# 30.12.2021
+
+import logging
+import time
+
+from ble_data_transfer_python.gen.deepcare.messages import (
+    StartTransferRequest, StartTransferResponse, StartTransferResponseStatus)
+
+
+class HLTransferBase:
+    """Common request/response state shared by the high level handlers.
+
+    Holds the current transfer request and response plus the transfer
+    timing, so optimizations to this bookkeeping apply to upload and
+    download alike.
+    """
+
+    def __init__(self, logger: logging.Logger) -> None:
+        """Constructor.
+
+        Args:
+            logger (logging.Logger): module logger of the concrete handler
+        """
+
+        self._logger = logger
+
+        # current request
+        self._request = StartTransferRequest()
+        # current response
+        self._response = StartTransferResponse()
+
+        # time stamp the data transfer was initiated, contains duration after transfer
+        self._timestamp = 0.0
+        # clock used for the timing, handlers that only need duration
+        # diffs can swap in time.perf_counter which is cheaper and not
+        # affected by wall clock jumps
+        self._clock = time.time
+
+    @property
+    def transfer_duration(self) -> float:
+        """Duration of last transfer.
+
+        Returns:
+            float: duration of file transfer in [s]
+        """
+
+        # if transfer in progress return time since start
+        if self._response.status == StartTransferResponseStatus.TRANSFER:
+            duration = self._clock() - self._timestamp
+
+        # return the duration of the last transfer
+        elif self._response.status == StartTransferResponseStatus.FINISHED:
+            duration = self._timestamp
+
+        # in all other cases return zero
+        else:
+            duration = 0.0
+
+        return round(duration, 2)
+
+    @property
+    def transferred_bytes(self) -> int:
+        """Number of transferred bytes.
+
+        Returns:
+            int: number of transferred bytes so far
+        """
+
+        return self._response.size
@@ -6,29 +6,47 @@
 
 import hashlib
 import logging
+import mmap
+import os
 import pathlib
+import queue
+import threading
 import time
-from typing import Callable, List
+from typing import Callable
 
 import coloredlogs
 
 from ble_data_transfer_python.gen.deepcare.messages import (
     StartTransferRequest, StartTransferResponse, StartTransferResponseStatus,
     Target)
+from ble_data_transfer_python.hl_base import HLTransferBase
 from ble_data_transfer_python.ll_receiver import LLReceiver
 
+# module logger, coloredlogs touches the global handler configuration so
+# it is installed once at import time instead of per instance
+_logger = logging.getLogger('HLDownload')
+coloredlogs.install(logger=_logger)
 
-class HLDownload:
+
+class HLDownload(HLTransferBase):
 
     # file name to use for storing the download request
     DOWNLOAD_REQUEST_FILE = 'request.json'
-    # base file name of the chunk files to use
-    DOWNLOAD_CHUNK_BASE_NAME = 'chunk'
+    # suffix of the partial output file the chunks are streamed into
+    DOWNLOAD_PART_SUFFIX = '.part'
+    # file name of the sidecar recording the end offset of every chunk
+    DOWNLOAD_OFFSETS_FILE = 'offsets.bin'
+    # transfers up to this size are buffered completely in memory and
+    # written to disk in one go at finalize
+    RAM_BUDGET = 4 * 1024 * 1024
+    # use SHA-256 for chunk and file verification:
+    # OpenSSL dispatches it to the SHA extensions (x86 SHA-NI, ARMv8 crypto)
+    # while MD5 always runs in software - disable for legacy peers only
+    USE_SHA256 = True
 
     def __init__(self, root_path: str, ll_receiver: LLReceiver, cb_finished: Callable[[pathlib.Path], None]) -> None:
 
-        self._logger = logging.getLogger(self.__class__.__name__)
-        coloredlogs.install(logger=self._logger)
+        super().__init__(_logger)
 
         # take over low lever receiver
         self._ll_receiver = ll_receiver
@@ -39,79 +57,208 @@ class HLDownload:
         self._download_path = pathlib.Path(root_path).joinpath('download')
         self._download_path.mkdir(parents=True, exist_ok=True)
 
-        # current request
-        self._request = StartTransferRequest()
-        # current response
-        self._response = StartTransferResponse()
+        # keep the download folder open so chunk files can be opened
+        # relative to it without re-walking the whole path per chunk
+        self._dir_fd = os.open(str(self._download_path), os.O_DIRECTORY)
+
+        # path of the persisted request, used in several places
+        self._request_path = self._download_path.joinpath(
+            self.DOWNLOAD_REQUEST_FILE)
+
+        # cache the hash constructor, the receive callback uses it per chunk
+        self._hash_ctor = hashlib.sha256 if self.USE_SHA256 else hashlib.md5
+
+        # running hash over all received chunks
+        self._file_hash = self._new_hash()
+
+        # fd of the partial output file the chunks are appended to
+        self._out_fd = None
+        # fd of the offsets sidecar used for resuming
+        self._offsets_fd = None
+
+        # collect the small BLE chunks in memory and write them to disk
+        # in blocks matching the file system block size
+        self._write_buf = bytearray()
+        self._offsets_buf = bytearray()
+        self._default_flush_threshold = min(
+            os.statvfs(self._download_path).f_bsize * 16, 64 * 1024)
+        self._flush_threshold = self._default_flush_threshold
+
+        # chunk counter and byte counter of the writer thread
+        self._written_chunks = 0
+        self._written_size = 0
 
-        # time stamp the data transfer was initiated, contains duration after transfer
-        self._timestamp = 0.0
+        # transfer generation, bumped on every reset so the writer can
+        # discard queued chunks that belong to an aborted transfer
+        self._generation = 0
 
         # check if a download was in progress and can be resumed
         self._resume_download()
 
+        # hashing and disk I/O run in a writer thread so the BLE receive
+        # callback only has to hand over the chunk
+        self._lock = threading.RLock()
+        self._chunk_queue = queue.SimpleQueue()
+        self._worker = threading.Thread(target=self._writer_loop, daemon=True)
+        self._worker.start()
+
     def _resume_download(self) -> None:
         """Internal function called during system startup to resume an ongoing download.
         """
 
-        # search for previous request
-        if self._download_path.joinpath(self.DOWNLOAD_REQUEST_FILE).is_file():
-            # file found - read it
-            with open(
-                    file=self._download_path.joinpath(
-                        self.DOWNLOAD_REQUEST_FILE),
-                    mode='r',
-                    encoding='utf-8') as request_file:
-                try:
-                    self._request.from_json(request_file.read())
-                except:
-                    self._logger.error(
-                        'invalid json file - can not resume download')
-                    # delete corrupt file
-                    self._download_path.joinpath(
-                        self.DOWNLOAD_REQUEST_FILE).unlink()
-                    # remove possible download artifacts
-                    self._delete_chunks()
-                    return
-
-            # call reset to setup response accordingly
-            self._reset(self._request)
-
-            # use number of already received chunks as next chunk number
-            self._response.next_chunk = len(
-                list(self._download_path.glob(f'{self.DOWNLOAD_CHUNK_BASE_NAME}*.bin')))
-
-            # use creation date of request file as start time
-            self._timestamp = self._download_path.joinpath(
-                self.DOWNLOAD_REQUEST_FILE).stat().st_atime
-
-            # use size of first chunk file (file name index 0) to calculate whole amount of already received bytes
-            if self._response.next_chunk > 0:
-                chunk_size = self._download_path.joinpath(
-                    f'{self.DOWNLOAD_CHUNK_BASE_NAME}0.bin').stat().st_size
-                self._response.size = chunk_size * self._response.next_chunk
+        # search for previous request, a single stat tells whether one
+        # exists and when it was started
+        try:
+            request_stat = self._request_path.stat()
+        except FileNotFoundError:
+            # no previous download in progress - delete possible artifacts
+            self._delete_artifacts()
+            return
+
+        # file found - read it
+        with open(file=self._request_path, mode='r',
+                  encoding='utf-8') as request_file:
+            try:
+                self._request.from_json(request_file.read())
+            except:
+                self._logger.error(
+                    'invalid json file - can not resume download')
+                # delete corrupt file
+                self._request_path.unlink()
+                # remove possible download artifacts
+                self._delete_artifacts()
+                return
+
+        try:
+            # call reset to setup response accordingly,
+            # keep the already received data
+            self._reset(self._request, resume=True)
+
+            # every completely received chunk appended one 8 byte end
+            # offset to the sidecar - the record count is the next chunk
+            # number, the last full record the amount of received bytes
+            # (a torn trailing record is ignored, so only full 8 byte
+            # records count)
+            offsets = self._download_path.joinpath(
+                self.DOWNLOAD_OFFSETS_FILE).read_bytes()
+            records = len(offsets) // 8
+            self._response.next_chunk = records
+            if records:
+                self._response.size = int.from_bytes(
+                    offsets[records * 8 - 8:records * 8], 'little')
+
+            # the partial file must cover all recorded bytes, otherwise
+            # the artifacts do not belong together (e.g. the partial
+            # file vanished and was just recreated empty by _reset)
+            if os.fstat(self._out_fd).st_size < self._response.size:
+                raise ValueError('partial file smaller than sidecar records')
+
+            # discard a possible partial write of an unrecorded chunk
+            # and continue writing at the end of the received data
+            os.ftruncate(self._out_fd, self._response.size)
+            os.lseek(self._out_fd, self._response.size, os.SEEK_SET)
+
+            # writer thread continues where the sidecar ended
+            self._written_chunks = self._response.next_chunk
+            self._written_size = self._response.size
+
+            # re-seed the running hash with the already received data,
+            # mapping the partial file feeds the hash straight from the
+            # page cache without an intermediate bytes object
+            if self._response.size > 0:
+                with open(self._download_path.joinpath(
+                        self._part_name(self._request)), 'rb') as part_file:
+                    with mmap.mmap(part_file.fileno(), self._response.size,
+                                   access=mmap.ACCESS_READ) as mapped:
+                        if hasattr(mapped, 'madvise'):
+                            mapped.madvise(mmap.MADV_SEQUENTIAL)
+                        self._file_hash.update(mapped)
+
+            # use access date of the request file stat from above as start time
+            self._timestamp = request_stat.st_atime
+
+        except Exception:
+            # corrupt artifacts must not crash the constructor on every
+            # boot - drop the partial download and wait for a new request
+            self._logger.exception(
+                'can not resume download - discarding artifacts')
+            self._request_path.unlink(missing_ok=True)
+            self._delete_artifacts()
+            self._request = StartTransferRequest()
+            self._response = StartTransferResponse()
+            self._file_hash = self._new_hash()
+            self._written_chunks = 0
+            self._written_size = 0
+            return
 
-            self._logger.info(
-                'found running update: next chunk=%d. size=%d, duration=%f',
-                self._response.next_chunk, self._response.size, self.transfer_duration)
+        self._logger.info(
+            'found running update: next chunk=%d. size=%d, duration=%f',
+            self._response.next_chunk, self._response.size, self.transfer_duration)
 
-        else:
-            # no previous download in progress - delete possible artifacts
-            self._delete_chunks()
+    def _new_hash(self) -> 'hashlib._Hash':
+        """Internal function to create a new hash object for data verification.
+
+        Returns:
+            hashlib._Hash: SHA-256 hash or MD5 if the legacy fallback is enabled
+        """
+
+        return self._hash_ctor()
+
+    def _part_name(self, request: StartTransferRequest) -> str:
+        """Internal function to build the name of the partial output file.
+
+        Args:
+            request (StartTransferRequest): transfer request
+
+        Returns:
+            str: file name of the partial output file
+        """
+
+        return request.filename + self.DOWNLOAD_PART_SUFFIX
+
+    def _flush_write_buf(self) -> None:
+        """Internal function to write the buffered chunks and their offset
+        records to disk.
+        """
+
+        if self._write_buf:
+            os.write(self._out_fd, self._write_buf)
+            self._write_buf.clear()
+        if self._offsets_buf:
+            os.write(self._offsets_fd, self._offsets_buf)
+            self._offsets_buf.clear()
+
+    def _close_artifact_fds(self) -> None:
+        """Internal function to close the partial output and sidecar files.
+        """
 
-    def _delete_chunks(self) -> None:
-        """Internal function to delete all download artifacts after successful file download.
+        if self._out_fd is not None:
+            self._flush_write_buf()
+            os.close(self._out_fd)
+            self._out_fd = None
+        if self._offsets_fd is not None:
+            os.close(self._offsets_fd)
+            self._offsets_fd = None
+
+    def _delete_artifacts(self) -> None:
+        """Internal function to delete all artifacts of an aborted download.
         """
 
-        # erase all chunks files
-        for item in self._download_path.glob(f'{self.DOWNLOAD_CHUNK_BASE_NAME}*.bin'):
-            item.unlink()
+        self._close_artifact_fds()
+
+        # erase partial output and sidecar files
+        with os.scandir(self._download_path) as entries:
+            for entry in entries:
+                if entry.name.endswith(self.DOWNLOAD_PART_SUFFIX) \
+                        or entry.name == self.DOWNLOAD_OFFSETS_FILE:
+                    os.unlink(entry.name, dir_fd=self._dir_fd)
 
-    def _reset(self, request: StartTransferRequest):
+    def _reset(self, request: StartTransferRequest, resume: bool = False):
         """Internal function to initiate a transfer depending on the request and internal condition.
 
         Args:
             request (StartTransferRequest): received transfer request
+            resume (bool): keep already received data of a resumed download
         """
 
         # take over request
@@ -126,6 +273,33 @@ class HLDownload:
         # ready for transfer
         self._response.status = StartTransferResponseStatus.TRANSFER
 
+        # start a new running hash for the whole file
+        self._file_hash = self._new_hash()
+
+        # open the partial output and sidecar files,
+        # a new transfer starts with empty files
+        self._close_artifact_fds()
+        self._out_fd = os.open(self._part_name(request),
+                               os.O_WRONLY | os.O_CREAT, 0o666,
+                               dir_fd=self._dir_fd)
+        self._offsets_fd = os.open(self.DOWNLOAD_OFFSETS_FILE,
+                                   os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                   0o666, dir_fd=self._dir_fd)
+        if not resume:
+            os.ftruncate(self._out_fd, 0)
+            os.ftruncate(self._offsets_fd, 0)
+
+        # discard possibly buffered chunks of a previous transfer
+        self._write_buf.clear()
+        self._offsets_buf.clear()
+        self._flush_threshold = self._default_flush_threshold
+        self._written_chunks = 0
+        self._written_size = 0
+
+        # invalidate chunks of the previous transfer that may still sit
+        # in the writer queue
+        self._generation += 1
+
         # take timestamp
         self._timestamp = time.time()
 
@@ -135,22 +309,22 @@ class HLDownload:
         Setup all internal variables to begin a new transmission.
         """
 
-        # if hash is different or no previous transfer was active
-        # than a new transfer is requested
-        if (self._request.hash != request.hash) or (self._response.status != StartTransferResponseStatus.TRANSFER):
-            # reset for handling a new request
-            self._reset(request)
-            # save request to disk
-            with open(
-                    file=self._download_path.joinpath(
-                        self.DOWNLOAD_REQUEST_FILE),
-                    mode='w',
-                    encoding='utf-8') as request_file:
-                request_file.write(self._request.to_json())
-            self._delete_chunks()
+        with self._lock:
+            # if hash is different or no previous transfer was active
+            # than a new transfer is requested
+            if (self._request.hash != request.hash) or (self._response.status != StartTransferResponseStatus.TRANSFER):
+                # remove artifacts of a possible aborted download
+                self._delete_artifacts()
+                # reset for handling a new request
+                self._reset(request)
+                # save request to disk
+                with open(file=self._request_path, mode='w',
+                          encoding='utf-8') as request_file:
+                    request_file.write(self._request.to_json())
 
         self._logger.info('start transfer request received')
-        self._logger.debug(request)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(request)
 
     def get_response(self) -> StartTransferResponse:
         """Get the transfer response.
@@ -160,74 +334,158 @@ class HLDownload:
         """
 
         self._logger.info('start transfer response requested')
-        self._logger.debug(self._response)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._response)
 
-        # check if transfer was requested which means that the chunk counter must be unequal zero
-        if self._response.chunks == 0:
-            self._response.status = StartTransferResponseStatus.ERROR
-            self._logger.error(
-                'number of chunks is zero: file transfer initiated ?')
+        with self._lock:
+            # check if transfer was requested which means that the chunk counter must be unequal zero
+            if self._response.chunks == 0:
+                self._response.status = StartTransferResponseStatus.ERROR
+                self._logger.error(
+                    'number of chunks is zero: file transfer initiated ?')
 
-        # check if more chunks were requested than available
-        elif self._response.next_chunk > self._response.chunks:
-            self._response.status = StartTransferResponseStatus.ERROR
-            self._logger.error('non-existant chunk requested')
+            # check if more chunks were requested than available
+            elif self._response.next_chunk > self._response.chunks:
+                self._response.status = StartTransferResponseStatus.ERROR
+                self._logger.error('non-existant chunk requested')
 
-        return self._response
+            return self._response
 
-    def add_chunk(self, chunk: List[bytes]) -> None:
+    def add_chunk(self, chunk: bytes) -> None:
         """Set as as callback in low level receiver.
 
         Executed each time a complete chunk was received from the app.
-        All chunks are stored on disk in sequence.
+        All chunks are appended to a single partial output file.
 
         Args:
-            chunk (List[bytes]): received chunk
+            chunk (bytes): received chunk
         """
 
-        # return hash
-        self._response.hash = hashlib.md5(chunk).digest()
+        with self._lock:
+            # work on a local reference, the response message is touched
+            # several times per chunk
+            response = self._response
+
+            # return hash of the received chunk (a real per-chunk tag,
+            # the cached constructor avoids an attribute chain per call)
+            response.hash = self._hash_ctor(chunk).digest()
 
-        # save chunk to disk
-        file_name = self._download_path.joinpath(
-            f'chunk{self._response.next_chunk}.bin')
-        with open(file_name, 'wb') as chunk_file:
-            chunk_file.write(chunk)
+            # update the bookkeeping the app polls for
+            response.size += len(chunk)
+            next_chunk = response.next_chunk + 1
+            response.next_chunk = next_chunk
+            response.duration = self.transfer_duration
 
-        # request next chunk
-        self._response.next_chunk += 1
+            # the chunk belongs to the transfer that is active now
+            generation = self._generation
 
         self._logger.info(
-            'new chunk (%d/%d) received (%s)', self._response.next_chunk, self._response.chunks, self._ll_receiver)
+            'new chunk (%d/%d) received (%s)', next_chunk, response.chunks, self._ll_receiver)
 
-        # check if all chunks were received
-        if self._response.next_chunk == self._response.chunks:
-            self._transfer_finished()
+        # hand the chunk to the writer thread, hashing and disk I/O
+        # happen off the BLE critical path
+        self._chunk_queue.put((generation, chunk))
 
-        # update transfer time
-        self._response.duration = self.transfer_duration
-        self._response.size += len(chunk)
+    def _writer_loop(self) -> None:
+        """Internal function executed by the writer thread.
+        """
 
-    def _transfer_finished(self):
+        while True:
+            generation, chunk = self._chunk_queue.get()
+            try:
+                self._process_chunk(generation, chunk)
+            except Exception:
+                # the writer must survive I/O errors (full disk, failed
+                # rename, ...) - dying silently would leave the response
+                # in TRANSFER forever and hang every later download
+                self._logger.exception('writer thread failed to persist chunk')
+                with self._lock:
+                    self._response.status = StartTransferResponseStatus.ERROR
+
+    def _process_chunk(self, generation: int, chunk: bytes) -> None:
+        """Internal function to hash and persist a received chunk.
+
+        Executed by the writer thread in reception order.
+
+        Args:
+            generation (int): transfer generation the chunk belongs to
+            chunk (bytes): received chunk
+        """
+
+        # arguments for the user callback, set on the final chunk
+        callback_args = None
+
+        with self._lock:
+            # discard stale chunks of an aborted transfer that were
+            # still queued when a new request reset the state - they
+            # must not be hashed or written into the new output file
+            if generation != self._generation:
+                return
+
+            # update the running hash of the whole file
+            self._file_hash.update(chunk)
+
+            # the first chunk gives a size estimate for the whole file
+            if self._written_chunks == 0:
+                estimate = len(chunk) * self._response.chunks
+
+                # small transfers stay in memory until finalize, skipping
+                # all disk I/O on the hot path for the common case
+                if estimate <= self.RAM_BUDGET:
+                    self._flush_threshold = estimate + 1
+
+                # preallocate the output once to avoid progressive extent
+                # allocation and fragmentation (best effort, Linux/POSIX only)
+                if hasattr(os, 'posix_fallocate'):
+                    try:
+                        os.posix_fallocate(self._out_fd, 0, estimate)
+                    except OSError:
+                        pass
+
+            # collect the chunk and its end offset record, flush to disk
+            # in file system sized blocks only
+            self._write_buf += chunk
+            self._written_size += len(chunk)
+            self._offsets_buf += self._written_size.to_bytes(8, 'little')
+            if len(self._write_buf) >= self._flush_threshold:
+                self._flush_write_buf()
+
+            # check if all chunks were received
+            self._written_chunks += 1
+            if self._written_chunks == self._response.chunks:
+                callback_args = self._transfer_finished()
+
+        # run the user callback outside the lock so a callback that
+        # synchronizes with another thread touching this instance
+        # cannot deadlock
+        if callback_args is not None:
+            self._cb_finished(*callback_args)
+
+    def _transfer_finished(self) -> tuple:
         """Internal function called after a file transfer has been finished.
+
+        Returns:
+            tuple: arguments for the user callback, to be invoked by the
+            caller after releasing the lock
         """
 
         # stop time
         self._timestamp = time.time() - self._timestamp
 
-        # cat the the chunks into the final file and calculate the hash
-        file_hash = hashlib.md5()
+        # the chunks were already streamed into the partial output file
+        # and the hash was computed on the fly while receiving - flush
+        # the file and move it to its final name
         file_name = self._download_path.joinpath(self._request.filename)
-        with open(file_name, 'wb') as binary_out:
-            for i in range(self._response.chunks):
-                chunk_name = self._download_path.joinpath(
-                    f'{self.DOWNLOAD_CHUNK_BASE_NAME}{i}.bin')
-                with open(chunk_name, 'rb') as fin:
-                    chunk = fin.read()
-                file_hash.update(chunk)
-                binary_out.write(chunk)
-
-        if file_hash.digest() == self._request.hash:
+        self._flush_write_buf()
+        # trim the preallocation to the real size (last chunk is shorter)
+        os.ftruncate(self._out_fd, self._response.size)
+        os.fsync(self._out_fd)
+        self._close_artifact_fds()
+        os.rename(self._part_name(self._request), self._request.filename,
+                  src_dir_fd=self._dir_fd, dst_dir_fd=self._dir_fd)
+        os.unlink(self.DOWNLOAD_OFFSETS_FILE, dir_fd=self._dir_fd)
+
+        if self._file_hash.digest() == self._request.hash:
             self._response.status = StartTransferResponseStatus.FINISHED
             self._logger.info(
                 '%s transferred in %0.1f s', self._request.filename, self._timestamp)
@@ -237,41 +495,16 @@ class HLDownload:
             self._logger.error('transfer finished - invalid hash')
 
         # erase request file (which is the indicator of an running download )
-        self._download_path.joinpath((self.DOWNLOAD_REQUEST_FILE)).unlink()
-
-        # call user callback
-        if self._response.status == StartTransferResponseStatus.FINISHED:
-            # use received file in case of success
-            self._cb_finished(file_name, self._request.target)
-        else:
-            # file reception was not successful
-            self._cb_finished(None, Target.UNKNOWN)
-
-    @property
-    def transfer_duration(self) -> float:
-        """Duration of last transfer.
+        self._request_path.unlink()
 
-        Returns:
-            float: duration of file transfer in [s]
-        """
-
-        # if transfer in progress return time since start
-        if self._response.status == StartTransferResponseStatus.TRANSFER:
-            return time.time() - self._timestamp
+        # freeze the transfer duration in the response
+        self._response.duration = self.transfer_duration
 
-        # return the duration of the last transfer
+        # hand the user callback arguments back to the caller
         if self._response.status == StartTransferResponseStatus.FINISHED:
-            return self._timestamp
-
-        # in all other cases return zero
-        return 0.0
-
-    @property
-    def transferred_bytes(self) -> int:
-        """Number of transferred bytes.
+            # use received file in case of success
+            return (file_name, self._request.target)
 
-        Returns:
-            int: number of transferred bytes so far
-        """
+        # file reception was not successful
+        return (None, Target.UNKNOWN)
 
-        return self._response.size
@@ -18,6 +18,11 @@ from ble_data_transfer_python.ll_sender import LLSender
 from ble_data_transfer_python.hl_download import HLDownload
 from ble_data_transfer_python.hl_upload import HLUpload
 
+# module logger, coloredlogs touches the global handler configuration so
+# it is installed once at import time instead of per instance
+_logger = logging.getLogger('HLTransceiver')
+coloredlogs.install(logger=_logger)
+
 
 class HLTransceiver():
     """Class providing sending and receiving of data.
@@ -33,8 +38,7 @@ class HLTransceiver():
             cb_download_finished (Callable[[pathlib.Path], None]): user callback executed if a file was downloaded completely
         """
 
-        self._logger = logging.getLogger(self.__class__.__name__)
-        coloredlogs.install(logger=self._logger)
+        self._logger = _logger
 
         # current request
         self._request = StartTransferRequest()
@@ -50,7 +54,9 @@ class HLTransceiver():
         ll_receiver.cb_new_data = self._download.add_chunk
 
         # create uploader instance
-        self._upload = HLUpload(root_path, ll_sender, 1024 * 100)
+        # 128 KiB: close to the previous 100 KiB but a power of two,
+        # as HLUpload now requires for its shift based chunk math
+        self._upload = HLUpload(root_path, ll_sender, 128 * 1024)
 
         self._logger.info('high level transceiver ready')
 
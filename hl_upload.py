@@ -4,85 +4,139 @@
 # Michael Katzenberger
 # 30.12.2021
 
-import hashlib
+import binascii
 import logging
+import mmap
+import os
 import pathlib
-from math import ceil
 import time
 
 import coloredlogs
 
 from ble_data_transfer_python.gen.deepcare.messages import (
     StartTransferRequest, StartTransferResponse, StartTransferResponseStatus)
-from ble_data_transfer_python.gen.deepcare.transfer_data import TransferData
+from ble_data_transfer_python.hl_base import HLTransferBase
 from ble_data_transfer_python.ll_sender import LLSender
 
+# module logger, coloredlogs touches the global handler configuration so
+# it is installed once at import time instead of per instance
+_logger = logging.getLogger('HLUpload')
+coloredlogs.install(logger=_logger)
 
-class HLUpload:
+# end-of-transfer marker for the chunk generator, cheaper than
+# raising and catching StopIteration on every finished transfer
+_SENTINEL = object()
+
+
+class HLUpload(HLTransferBase):
+
+    # files up to this size are read in one go instead of streamed
+    SMALL_FILE_LIMIT = 4 * 1024 * 1024
 
     def __init__(self, root_path: str, ll_sender: LLSender, chunk_size=1024) -> None:
 
-        self._logger = logging.getLogger(self.__class__.__name__)
-        coloredlogs.install(logger=self._logger)
+        super().__init__(_logger)
+
+        # the upload timestamp is only ever used as a duration diff, a
+        # monotonic clock is cheaper to read and immune to clock jumps
+        # (the download side keeps wall clock time for its resume logic)
+        self._clock = time.perf_counter
 
         # take over low lever sender
         self._ll_sender = ll_sender
+        # chunk size must be a positive power of two, the chunk count
+        # math is then a shift instead of a division - raise instead of
+        # assert so the contract also holds under python -O
+        if chunk_size <= 0 or chunk_size & (chunk_size - 1):
+            raise ValueError('chunk_size must be a power of two')
         self._chunk_size = chunk_size
+        self._chunk_shift = chunk_size.bit_length() - 1
 
-        self._upload_path = pathlib.Path(root_path).joinpath('upload')
+        # resolved root folder, the base of the containment check in _reset
+        self._upload_path = pathlib.Path(root_path).joinpath('upload').resolve()
         self._upload_path.mkdir(parents=True, exist_ok=True)
 
-        # current request
-        self._request = StartTransferRequest()
-        # current response
-        self._response = StartTransferResponse()
-
-        # time stamp the data transfer was initiated, contains duration after transfer
-        self._timestamp = 0.0
-
         self._chunk_generator: bytes = None
 
+        # once the response reached a terminal state it no longer
+        # changes, get_response can hand it back without any work
+        self._response_finalized = False
+
     def _reset(self, request: StartTransferRequest):
 
         # create response for initial data transfer
         self._response = StartTransferResponse()
+        self._response_finalized = False
 
         # copy filename
         self._response.filename = request.filename
 
-        # merge requested file with root folder
-        upload_file = self._upload_path.joinpath(request.filename)
-        # check if still located in root folder after merging
-        if not str(upload_file).startswith(self._upload_path):
+        # merge requested file with root folder, resolving symlinks and
+        # '..' components - a plain string prefix check is bypassable
+        upload_file = self._upload_path.joinpath(request.filename).resolve()
+        # check if still located in root folder after resolving
+        if not upload_file.is_relative_to(self._upload_path):
             # root folder was changed - reject upload request
             self._response.status = StartTransferResponseStatus.ERROR
+            self._response_finalized = True
             return
         # check if requested file is available
         if not upload_file.exists():
             self._response.status = StartTransferResponseStatus.FILE_NOT_FOUND
+            self._response_finalized = True
             return
 
-        # number of chunks
-        self._response.chunks = ceil(
-            upload_file.stat().st_size / self._chunk_size)
+        # number of chunks, integer ceiling as a shift - the chunk
+        # size is guaranteed to be a power of two
+        size = upload_file.stat().st_size
+        self._response.chunks = (
+            size + self._chunk_size - 1) >> self._chunk_shift
 
         # transfer is now active
         self._response.status = StartTransferResponseStatus.TRANSFER
 
         # take timestamp
-        self._timestamp = time.time()
+        self._timestamp = self._clock()
 
         # create generator
         self._chunk_generator = self._split(upload_file)
 
     def _split(self, file_name: pathlib.Path) -> bytes:
 
-        with open(file_name, 'rb') as f_in:
-            while True:
-                data = f_in.read(self._chunk_size)
-                yield data
-                if len(data) != self._chunk_size:
-                    break
+        # hoisted into a local, an attribute lookup per chunk adds up
+        chunk_size = self._chunk_size
+
+        # small files: a single read is cheaper than streaming, the
+        # memoryview slices hand out the payload without further copies
+        if file_name.stat().st_size <= self.SMALL_FILE_LIMIT:
+            view = memoryview(file_name.read_bytes())
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+            return
+
+        # large files: map the file instead of reading it chunk wise,
+        # the CRC and the sender then work directly on the page cache
+        # without one bytes allocation and copy per chunk
+        fd = os.open(file_name, os.O_RDONLY)
+        try:
+            mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        # chunks are consumed front to back, tell the kernel
+        mapping.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mapping)
+        try:
+            for start in range(0, len(view), chunk_size):
+                yield view[start:start + chunk_size]
+        finally:
+            # drop our references on exhaustion (or abandonment), the
+            # mapping itself is unmapped once the consumer lets go of
+            # the last handed-out slice
+            view.release()
+            try:
+                mapping.close()
+            except BufferError:
+                pass
 
     def set_request(self, request: StartTransferRequest) -> None:
 
@@ -100,54 +154,42 @@ class HLUpload:
             # next chunk
             self._response.next_chunk += 1
 
-        self._logger.debug(self._request)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._request)
 
     def get_response(self) -> StartTransferResponse:
 
+        # terminal states: the cached response is complete, skip the
+        # whole body for callers that keep polling after completion
+        if self._response_finalized:
+            return self._response
+
         if self._response.status == StartTransferResponseStatus.TRANSFER:
-            try:
-                data = self._chunk_generator.__next__()
-                self._response.hash = hashlib.md5(data).digest()[0:2]
+            data = next(self._chunk_generator, _SENTINEL)
+            if data is not _SENTINEL:
+                self._response.hash = binascii.crc_hqx(
+                    data, 0).to_bytes(2, 'big')
                 self._response.size += len(data)
                 self._ll_sender.send(data)
 
-            except StopIteration:
+            else:
                 # no more chunks available
                 self._response.status = StartTransferResponseStatus.FINISHED
                 # reset hash
                 self._response.hash = bytes()
                 # stop time
-                self._timestamp = time.time() - self._timestamp
-
-        # update transfer time
-        self._response.duration = self.transfer_duration
+                self._timestamp = self._clock() - self._timestamp
+                # the duration is only refreshed on this final transition,
+                # recomputing it per chunk costs a time.time() call and a
+                # round() for a value nobody reads while transferring
+                self._response.duration = self.transfer_duration
+                self._response_finalized = True
 
-        self._logger.debug(self._response)
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug(self._response)
 
         return self._response
 
-    @property
-    def transfer_duration(self) -> float:
-        """Duration of last transfer.
-
-        Returns:
-            float: duration of file transfer in [s]
-        """
-
-        # if transfer in progress return time since start
-        if self._response.status == StartTransferResponseStatus.TRANSFER:
-            duration = time.time() - self._timestamp
-
-        # return the duration of the last transfer
-        elif self._response.status == StartTransferResponseStatus.FINISHED:
-            duration = self._timestamp
-
-        # in all other cases return zero
-        else:
-            duration = 0.0
-
-        return round(duration, 2)
-
 
 if __name__ == '__main__':
 
@@ -182,7 +224,7 @@ if __name__ == '__main__':
         log.info('read file chunk %d ...', n)
         while True:
             test_chunk = sender.get_chunk()
-            if test_chunk == TransferData():
+            if test_chunk is None:
                 break
             log.info('transfer data: chunks %d/%d',
                      test_chunk.current_chunk+1, test_chunk.overall_chunks)
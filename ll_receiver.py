@@ -4,13 +4,17 @@
 # Michael Katzenberger
 # 29.12.2021
 
-import hashlib
+import binascii
 import time
 from enum import Enum
-from typing import Callable, List
+from typing import Callable
 
 from ble_data_transfer_python.gen.deepcare.transfer_data import TransferData
 
+# module level alias, saves the binascii attribute lookup on the
+# per-chunk verify path
+_crc16 = binascii.crc_hqx
+
 
 class LLReceiverError(Enum):
     """Low level error definitions
@@ -24,18 +28,19 @@ class LLReceiver():
     """Class providing reception of chunked data.
     """
 
-    def __init__(self, cb_new_data: Callable[[List[bytes]], None] = None) -> None:
+    def __init__(self, cb_new_data: Callable[[bytes], None] = None) -> None:
         """Constructor.
 
         Args:
-            cb_new_data (Callable[[List[bytes]], None], optional):
+            cb_new_data (Callable[[bytes], None], optional):
             callback executed if new data are available (complete transfer). Defaults to None.
         """
 
         # number of chunks expected
         self._remaining_chunks = 0
-        # received data
-        self._data = bytes()
+        # received data, a bytearray grows in place instead of
+        # reallocating the whole buffer on every appended chunk
+        self._data = bytearray()
         # time stamp the data transfer was initiated, contains duration after transfer
         self._timestamp = 0.0
         # flag to indicate that new unread data are available
@@ -54,8 +59,9 @@ class LLReceiver():
         """
 
         self._remaining_chunks = num_of_chunks
-        self._data = bytes()
-        self._timestamp = time.time()
+        self._data = bytearray()
+        # monotonic clock, the stamp is only ever used as a duration diff
+        self._timestamp = time.perf_counter()
         self.new_data = False
         self.error = LLReceiverError.NONE
 
@@ -80,14 +86,14 @@ class LLReceiver():
             self.error = LLReceiverError.WRONG_SEQUENCE
             return -1
 
-        # calc and verify hash
-        chunk_hash = hashlib.md5(bytes(chunk.data)).digest()[0:2]
-        if chunk_hash != bytes(chunk.hash):
+        # calc and verify hash (CRC-16, must match the sender side),
+        # compared as plain ints so no temporary bytes are created
+        if _crc16(chunk.data, 0) != int.from_bytes(chunk.hash, 'big'):
             self.error = LLReceiverError.WRONG_HASH
             return -1
 
-        # join received byte list
-        self._data += bytes(chunk.data)
+        # append received bytes in place
+        self._data.extend(chunk.data)
         self._remaining_chunks -= 1
 
         # if last chunk than set new data flag
@@ -95,10 +101,12 @@ class LLReceiver():
             # new data are now available
             self.new_data = True
             # after transfer time stamp contains the data transfer duration
-            self._timestamp = time.time() - self._timestamp
-            # if callback is set execute it
+            self._timestamp = time.perf_counter() - self._timestamp
+            # if callback is set execute it with an immutable copy -
+            # consumers may process it on another thread while a
+            # malformed chunk could still grow the internal buffer
             if self._cb_new_data:
-                self._cb_new_data(self._data)
+                self._cb_new_data(bytes(self._data))
 
         return self._remaining_chunks
 
@@ -136,7 +144,8 @@ class LLReceiver():
         """
 
         self.new_data = False
-        return self._data
+        # hand out an immutable copy, the internal buffer is reused
+        return bytes(self._data)
 
     def __str__(self) -> str:
 
@@ -154,15 +163,15 @@ class LLReceiver():
         return 'idle'
 
     @property
-    def cb_new_data(self) -> Callable[[List[bytes]], None]:
+    def cb_new_data(self) -> Callable[[bytes], None]:
         """Callback executed for new received data (chunks).
 
         Returns:
-            Callable[[List[bytes]], None]: user callback to consume the received data
+            Callable[[bytes], None]: user callback to consume the received data
         """
 
         return self._cb_new_data
 
     @cb_new_data.setter
-    def cb_new_data(self, fcn: Callable[[List[bytes]], None]):
+    def cb_new_data(self, fcn: Callable[[bytes], None]):
         self._cb_new_data = fcn